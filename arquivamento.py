@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import stat
+from datetime import date, datetime
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from database import engine
+from models import Enduro, Competitor, Checkpoint, Tempo, Category, Previsao
+
+
+# Diretório onde ficam os arquivos SQLite dos enduros finalizados
+ARQUIVOS_DIR = "./arquivos"
+
+# Tabelas copiadas para o arquivo, com o filtro das linhas que pertencem ao enduro.
+# As categorias são oferecidas a todos os enduros, então o arquivo leva as criadas
+# neste enduro e também as que os competidores dele usam
+TABELAS_ARQUIVADAS = [
+    (Tempo.__tablename__, "enduro_id = :enduro_id"),
+    (Checkpoint.__tablename__, "enduro_id = :enduro_id"),
+    (Competitor.__tablename__, "enduro_id = :enduro_id"),
+    (
+        Category.__tablename__,
+        "enduro_id = :enduro_id OR id IN (SELECT categories_id FROM main.competitors WHERE enduro_id = :enduro_id)",
+    ),
+    (Enduro.__tablename__, "id = :enduro_id"),
+]
+
+# Linhas removidas do banco principal, na mesma transação da cópia. As previsões são
+# derivadas e não vão para o arquivo; uma categoria criada neste enduro continua no
+# banco se algum competidor de outro enduro a usa
+TABELAS_REMOVIDAS = [
+    (Previsao.__tablename__, "enduro_id = :enduro_id"),
+    (Tempo.__tablename__, "enduro_id = :enduro_id"),
+    (Checkpoint.__tablename__, "enduro_id = :enduro_id"),
+    (Competitor.__tablename__, "enduro_id = :enduro_id"),
+    (
+        Category.__tablename__,
+        "enduro_id = :enduro_id AND id NOT IN "
+        "(SELECT categories_id FROM main.competitors WHERE categories_id IS NOT NULL)",
+    ),
+    (Enduro.__tablename__, "id = :enduro_id"),
+]
+
+
+def caminho_arquivo(enduro_id: int) -> str:
+    """Retorna o caminho do arquivo SQLite de um enduro arquivado."""
+    return os.path.join(ARQUIVOS_DIR, f"enduro_{enduro_id}.db")
+
+
+def enduro_finalizado(enduro: Enduro) -> bool:
+    """Um enduro está finalizado depois do dia da prova; uma data inválida não conta."""
+    try:
+        return datetime.strptime(enduro.date, "%Y-%m-%d").date() < date.today()
+    except (TypeError, ValueError):
+        return False
+
+
+def _remover(caminho: str):
+    if os.path.exists(caminho):
+        # Os arquivos prontos são somente leitura
+        os.chmod(caminho, stat.S_IRUSR | stat.S_IWUSR)
+        os.remove(caminho)
+
+
+def arquivar_enduro(db: Session, enduro_id: int) -> str:
+    """
+    Move as linhas de um enduro finalizado para um arquivo SQLite próprio,
+    somente leitura, e remove essas linhas do banco principal. A cópia e a
+    remoção são um único commit sobre o banco principal e o arquivo anexado,
+    que o SQLite torna atômico no journal "delete" usado pelo banco.
+    """
+    enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
+    if not enduro:
+        raise HTTPException(status_code=404, detail="Enduro não encontrado")
+    if not enduro_finalizado(enduro):
+        raise HTTPException(status_code=409, detail="Só é possível arquivar um enduro depois do dia da prova")
+
+    os.makedirs(ARQUIVOS_DIR, exist_ok=True)
+    caminho = caminho_arquivo(enduro_id)
+    # Com o enduro ainda no banco principal, um arquivo com o mesmo id é resto de uma
+    # tentativa que não chegou ao commit; as linhas dele continuam no banco
+    _remover(caminho)
+
+    # O arquivo é montado em um caminho temporário e só é renomeado depois do commit
+    temporario = caminho + ".tmp"
+    _remover(temporario)
+
+    parametros = {"enduro_id": enduro_id}
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("ATTACH DATABASE ? AS arquivo", (temporario,))
+            try:
+                # Trava as gravações da cópia até a remoção, para nenhum tempo novo ficar de fora
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                for tabela, filtro in TABELAS_ARQUIVADAS:
+                    # SELECT * preserva as colunas de checkpoint criadas dinamicamente em "tempos"
+                    conn.exec_driver_sql(
+                        f'CREATE TABLE arquivo."{tabela}" AS SELECT * FROM main."{tabela}" WHERE {filtro}',
+                        parametros,
+                    )
+                    conn.exec_driver_sql(f'CREATE UNIQUE INDEX arquivo."ix_{tabela}_id" ON "{tabela}" (id)')
+                for tabela, filtro in TABELAS_REMOVIDAS:
+                    conn.exec_driver_sql(f'DELETE FROM main."{tabela}" WHERE {filtro}', parametros)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.exec_driver_sql("DETACH DATABASE arquivo")
+    except Exception:
+        _remover(temporario)
+        raise
+
+    _publicar(temporario, caminho)
+    return caminho
+
+
+def _publicar(temporario: str, caminho: str):
+    os.replace(temporario, caminho)
+    os.chmod(caminho, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+def concluir_arquivamentos(db: Session):
+    """
+    Trata os arquivos temporários deixados por uma queda durante o arquivamento.
+    Se o enduro já saiu do banco principal o commit aconteceu e o arquivo está
+    completo, faltando só renomeá-lo; senão o arquivo é descartado.
+    """
+    if not os.path.isdir(ARQUIVOS_DIR):
+        return
+
+    for nome in os.listdir(ARQUIVOS_DIR):
+        if not (nome.startswith("enduro_") and nome.endswith(".db.tmp")):
+            continue
+        try:
+            enduro_id = int(nome[len("enduro_"):-len(".db.tmp")])
+        except ValueError:
+            continue
+        temporario = os.path.join(ARQUIVOS_DIR, nome)
+        if db.query(Enduro.id).filter(Enduro.id == enduro_id).first():
+            _remover(temporario)
+        else:
+            _publicar(temporario, caminho_arquivo(enduro_id))
+
+
+def listar_arquivados() -> list:
+    """Lista os enduros arquivados lendo a linha do enduro de cada arquivo."""
+    if not os.path.isdir(ARQUIVOS_DIR):
+        return []
+
+    enduros = []
+    for nome in sorted(os.listdir(ARQUIVOS_DIR)):
+        if not (nome.startswith("enduro_") and nome.endswith(".db")):
+            continue
+        caminho = os.path.abspath(os.path.join(ARQUIVOS_DIR, nome))
+        conn = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+        try:
+            conn.row_factory = sqlite3.Row
+            enduros.extend(dict(row) for row in conn.execute("SELECT * FROM enduros"))
+        finally:
+            conn.close()
+    return enduros
+
+
+# Dependência para consultar um enduro arquivado com as mesmas classes do banco principal
+def get_db_arquivo(enduro_id: int):
+    caminho = caminho_arquivo(enduro_id)
+    if not os.path.exists(caminho):
+        raise HTTPException(status_code=404, detail="Enduro arquivado não encontrado")
+
+    conn = engine.connect()
+    conn.exec_driver_sql("ATTACH DATABASE ? AS arquivo", (caminho,))
+    conn.exec_driver_sql("PRAGMA query_only = ON")
+    # As tabelas sem schema passam a apontar para o banco anexado
+    conn = conn.execution_options(schema_translate_map={None: "arquivo"})
+    db = Session(bind=conn)
+    try:
+        yield db
+    finally:
+        db.close()
+        conn.rollback()
+        conn.exec_driver_sql("PRAGMA query_only = OFF")
+        conn.exec_driver_sql("DETACH DATABASE arquivo")
+        conn.close()
@@ -0,0 +1,121 @@
+"""
+Benchmark do custo por requisição dos middlewares.
+
+Compara o antigo clear_flash_messages (@app.middleware("http"), que passa
+pelo BaseHTTPMiddleware) com o FlashMiddleware ASGI puro, e mede a
+compressão de uma página grande com e sem o cache de respostas comprimidas.
+
+Uso: python bench_middleware.py [quantidade de requisições]
+"""
+import asyncio
+import sys
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import HTMLResponse
+from starlette.routing import Route
+
+from middlewares import FlashMiddleware, CompressaoMiddleware, brotli
+
+
+PAGINA_GRANDE = "<table>" + "".join(
+    f"<tr><td>{i}</td><td>Competidor {i}</td><td>09:{i % 60:02}</td></tr>" for i in range(5000)
+) + "</table>"
+
+
+def criar_app(pagina: str) -> Starlette:
+    async def index(request):
+        return HTMLResponse(pagina)
+
+    return Starlette(routes=[Route("/", index)])
+
+
+def app_base_http(pagina: str) -> Starlette:
+    """Mesma aplicação com o middleware flash antigo, via BaseHTTPMiddleware."""
+    app = criar_app(pagina)
+
+    async def clear_flash_messages(request: Request, call_next):
+        response = await call_next(request)
+
+        if request.cookies.get("flash_message"):
+            response.delete_cookie("flash_message")
+            response.delete_cookie("flash_category")
+
+        return response
+
+    app.add_middleware(BaseHTTPMiddleware, dispatch=clear_flash_messages)
+    return app
+
+
+def app_asgi(pagina: str) -> Starlette:
+    app = criar_app(pagina)
+    app.add_middleware(FlashMiddleware)
+    return app
+
+
+def app_compressao(pagina: str, cache_max: int) -> Starlette:
+    app = criar_app(pagina)
+    app.add_middleware(CompressaoMiddleware, minimo=500, cache_max=cache_max)
+    return app
+
+
+async def medir(app, quantidade: int, headers: list) -> float:
+    """Chama a aplicação ASGI diretamente e retorna microssegundos por requisição."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # Aquecimento (monta a pilha de middlewares e preenche caches)
+    for _ in range(50):
+        await app(dict(scope), receive, send)
+
+    inicio = time.perf_counter()
+    for _ in range(quantidade):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - inicio) / quantidade * 1_000_000
+
+
+async def main(quantidade: int):
+    sem_cookie = [(b"host", b"localhost")]
+    com_cookie = sem_cookie + [(b"cookie", b"flash_message=ok; flash_category=success")]
+    pagina_pequena = "<p>ok</p>"
+
+    print(f"{quantidade} requisições por cenário, em µs por requisição\n")
+    print("Mensagens flash (página pequena)")
+    for nome, headers in (("sem cookie", sem_cookie), ("com cookie", com_cookie)):
+        antigo = await medir(app_base_http(pagina_pequena), quantidade, headers)
+        novo = await medir(app_asgi(pagina_pequena), quantidade, headers)
+        print(f"  {nome:<12} BaseHTTPMiddleware {antigo:8.1f}   ASGI {novo:8.1f}   economia {antigo - novo:8.1f}")
+
+    print(f"\nCompressão (página de {len(PAGINA_GRANDE) // 1024} KB)")
+    sem_compressao = await medir(criar_app(PAGINA_GRANDE), quantidade, sem_cookie)
+    print(f"  sem compressão          {sem_compressao:8.1f}")
+    codificacoes = (b"gzip", b"br") if brotli is not None else (b"gzip",)
+    for codificacao in codificacoes:
+        headers = sem_cookie + [(b"accept-encoding", codificacao)]
+        sem_cache = await medir(app_compressao(PAGINA_GRANDE, cache_max=0), quantidade, headers)
+        com_cache = await medir(app_compressao(PAGINA_GRANDE, cache_max=256), quantidade, headers)
+        print(f"  {codificacao.decode():<4} sem cache {sem_cache:8.1f}   com cache {com_cache:8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,303 @@
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+from sqlalchemy.orm import Session
+
+
+# Diretório do log de passagens e do snapshot do estado derivado
+EVENTOS_DIR = os.environ.get("EVENTOS_DIR", "./eventos")
+SNAPSHOT_INTERVALO = int(os.environ.get("EVENTOS_SNAPSHOT", "500"))  # Eventos entre dois snapshots
+
+LOG_NOME = "passagens.log"
+SNAPSHOT_NOME = "snapshot.json"
+
+
+def _codificar(evento: dict) -> bytes:
+    """Cada linha do log é "<crc32 em hex> <evento em JSON>"."""
+    corpo = json.dumps(evento, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(corpo), corpo)
+
+
+def _decodificar(linha: bytes):
+    """Retorna o evento da linha, ou None se ela estiver incompleta ou corrompida."""
+    if not linha.endswith(b"\n") or len(linha) < 10 or linha[8:9] != b" ":
+        return None
+    corpo = linha[9:-1]
+    try:
+        if int(linha[:8], 16) != zlib.crc32(corpo):
+            return None
+        return json.loads(corpo)
+    except ValueError:
+        return None
+
+
+def ler_eventos(caminho: str, offset: int = 0):
+    """
+    Lê os eventos válidos do log a partir de um offset, parando na primeira linha
+    inválida. Gera tuplas (evento, offset logo após o evento); serve também para
+    reproduzir uma prova real em benchmarks.
+    """
+    with open(caminho, "rb") as arquivo:
+        arquivo.seek(offset)
+        for linha in arquivo:
+            evento = _decodificar(linha)
+            if evento is None:
+                return
+            offset += len(linha)
+            yield evento, offset
+
+
+class EstadoPassagens:
+    """Estado derivado dos tempos: a passagem de cada competidor em cada checkpoint."""
+
+    def __init__(self, passagens: dict = None):
+        self.passagens = passagens or {}
+        # Índice checkpoint -> competidor -> passagem, para a consulta da cronometragem
+        self.por_checkpoint = {}
+        for passagem in self.passagens.values():
+            self._indexar(passagem)
+
+    @staticmethod
+    def chave(competitor_id: int, checkpoint_id: int) -> str:
+        return f"{competitor_id}:{checkpoint_id}"
+
+    def _indexar(self, passagem: dict):
+        self.por_checkpoint.setdefault(passagem["checkpoint_id"], {})[passagem["competitor_id"]] = passagem
+
+    def aplicar(self, evento: dict):
+        if evento["tipo"] == "passagem":
+            passagem = {
+                "enduro_id": evento["enduro_id"],
+                "checkpoint_id": evento["checkpoint_id"],
+                "competitor_id": evento["competitor_id"],
+                "largada": evento["largada"],
+            }
+            self.passagens[self.chave(evento["competitor_id"], evento["checkpoint_id"])] = passagem
+            self._indexar(passagem)
+        elif evento["tipo"] == "arquivamento":
+            self.passagens = {
+                chave: passagem for chave, passagem in self.passagens.items()
+                if passagem["enduro_id"] != evento["enduro_id"]
+            }
+            self.por_checkpoint = {}
+            for passagem in self.passagens.values():
+                self._indexar(passagem)
+
+    def do_checkpoint(self, checkpoint_id: int) -> list:
+        return list(self.por_checkpoint.get(checkpoint_id, {}).values())
+
+
+def _evento_passagem(enduro_id, checkpoint_id, competitor_id, largada) -> dict:
+    return {
+        "tipo": "passagem",
+        "enduro_id": enduro_id,
+        "checkpoint_id": checkpoint_id,
+        "competitor_id": competitor_id,
+        "largada": largada,
+    }
+
+
+class RegistroEventos:
+    """
+    Log append-only com checksum de cada mutação de tempo, mais snapshots
+    periódicos do estado derivado. Na recuperação só a cauda após o último
+    snapshot é reprocessada.
+    """
+
+    def __init__(self, diretorio: str = EVENTOS_DIR, intervalo_snapshot: int = SNAPSHOT_INTERVALO):
+        self.diretorio = diretorio
+        self.intervalo_snapshot = intervalo_snapshot
+        self.caminho_log = os.path.join(diretorio, LOG_NOME)
+        self.caminho_snapshot = os.path.join(diretorio, SNAPSHOT_NOME)
+        self.estado = EstadoPassagens()
+        self.seq = 0
+        self._desde_snapshot = 0
+        self._arquivo = None
+        self._lock = threading.Lock()
+        self.importado = False  # Tempos anteriores ao log já foram trazidos para o estado
+
+    def recuperar(self, db: Session = None) -> EstadoPassagens:
+        """
+        Carrega o último snapshot e reaplica os eventos gravados depois dele. Com a
+        sessão do banco, acerta "tempos" apenas com os eventos dessa cauda, e na
+        primeira execução importa os tempos gravados antes de o log existir.
+        """
+        os.makedirs(self.diretorio, exist_ok=True)
+
+        offset = 0
+        if os.path.exists(self.caminho_snapshot):
+            with open(self.caminho_snapshot, encoding="utf-8") as arquivo:
+                snapshot = json.load(arquivo)
+            self.seq = snapshot["seq"]
+            offset = snapshot["offset"]
+            self.estado = EstadoPassagens(snapshot["passagens"])
+            self.importado = snapshot.get("importado", False)
+
+        cauda = []
+        if os.path.exists(self.caminho_log):
+            for evento, offset in ler_eventos(self.caminho_log, offset):
+                self.estado.aplicar(evento)
+                self.seq = evento["seq"]
+                self._desde_snapshot += 1
+                cauda.append(evento)
+            # Descarta uma cauda incompleta deixada por uma queda no meio da escrita
+            if os.path.getsize(self.caminho_log) > offset:
+                with open(self.caminho_log, "r+b") as arquivo:
+                    arquivo.truncate(offset)
+
+        self._arquivo = open(self.caminho_log, "ab")
+
+        if db is not None:
+            self.reconciliar(db, cauda)
+            if not self.importado:
+                self.importar_tempos(db)
+                self.snapshot()
+
+        if self._desde_snapshot >= self.intervalo_snapshot:
+            self.snapshot()
+
+        return self.estado
+
+    def reconciliar(self, db: Session, eventos: list):
+        """
+        Acerta o banco com os eventos da cauda do log depois de uma queda. O evento
+        é gravado antes do commit, então uma passagem que falta ou difere em
+        "tempos" é regravada lá. Um arquivamento cujo enduro continua no banco não
+        chegou ao fim, e as passagens desse enduro voltam para o estado.
+        """
+        # Importado aqui para que o replay pela linha de comando não abra o banco
+        from models import Enduro, Tempo
+
+        for enduro_id in {evento["enduro_id"] for evento in eventos if evento["tipo"] == "arquivamento"}:
+            if db.query(Enduro.id).filter(Enduro.id == enduro_id).first():
+                self.restaurar_enduro(db, enduro_id)
+
+        chaves = {
+            EstadoPassagens.chave(evento["competitor_id"], evento["checkpoint_id"])
+            for evento in eventos if evento["tipo"] == "passagem"
+        }
+        with self._lock:
+            passagens = [self.estado.passagens[chave] for chave in chaves if chave in self.estado.passagens]
+        if not passagens:
+            return
+
+        tempos = {
+            EstadoPassagens.chave(tempo.competitor_id, tempo.checkpoint_id): tempo
+            for tempo in db.query(Tempo).filter(
+                Tempo.checkpoint_id.in_({passagem["checkpoint_id"] for passagem in passagens}),
+                Tempo.competitor_id.in_({passagem["competitor_id"] for passagem in passagens}),
+            )
+        }
+        for passagem in passagens:
+            tempo = tempos.get(EstadoPassagens.chave(passagem["competitor_id"], passagem["checkpoint_id"]))
+            if tempo is None:
+                db.add(Tempo(
+                    enduro_id=passagem["enduro_id"],
+                    checkpoint_id=passagem["checkpoint_id"],
+                    competitor_id=passagem["competitor_id"],
+                    largada=passagem["largada"],
+                ))
+            elif tempo.largada != passagem["largada"]:
+                tempo.largada = passagem["largada"]
+        db.commit()
+
+    def restaurar_enduro(self, db: Session, enduro_id: int):
+        """Recoloca no estado as passagens de um enduro cujo arquivamento não foi concluído."""
+        from models import Tempo
+
+        tempos = db.query(Tempo.enduro_id, Tempo.checkpoint_id, Tempo.competitor_id, Tempo.largada).filter(
+            Tempo.enduro_id == enduro_id, Tempo.largada.isnot(None)
+        ).all()
+        with self._lock:
+            for tempo in tempos:
+                self.estado.aplicar(_evento_passagem(*tempo))
+
+    def importar_tempos(self, db: Session):
+        """
+        Importa para o estado, uma única vez, os tempos gravados antes de o log
+        existir. O snapshot seguinte marca a importação como feita.
+        """
+        from models import Tempo
+
+        tempos = db.query(Tempo.enduro_id, Tempo.checkpoint_id, Tempo.competitor_id, Tempo.largada).filter(
+            Tempo.largada.isnot(None)
+        ).all()
+        with self._lock:
+            for tempo in tempos:
+                if EstadoPassagens.chave(tempo.competitor_id, tempo.checkpoint_id) not in self.estado.passagens:
+                    self.estado.aplicar(_evento_passagem(*tempo))
+            self.importado = True
+
+    def registrar(self, tipo: str, **dados) -> dict:
+        """
+        Grava o evento no disco (com fsync) antes de aplicá-lo ao estado.
+        Deve ser chamado antes do commit da mesma mutação no banco.
+        """
+        with self._lock:
+            evento = {"seq": self.seq + 1, "tipo": tipo, "ts": time.time(), **dados}
+            self._arquivo.write(_codificar(evento))
+            self._arquivo.flush()
+            os.fsync(self._arquivo.fileno())
+
+            self.seq = evento["seq"]
+            self.estado.aplicar(evento)
+            self._desde_snapshot += 1
+            if self._desde_snapshot >= self.intervalo_snapshot:
+                self._gravar_snapshot()
+            return evento
+
+    def do_checkpoint(self, checkpoint_id: int) -> list:
+        """Passagens de um checkpoint, copiadas sob o lock para não concorrer com registrar()."""
+        with self._lock:
+            return self.estado.do_checkpoint(checkpoint_id)
+
+    def snapshot(self):
+        with self._lock:
+            self._gravar_snapshot()
+
+    def _gravar_snapshot(self):
+        dados = {
+            "seq": self.seq,
+            "offset": self._arquivo.tell(),
+            "passagens": self.estado.passagens,
+            "importado": self.importado,
+        }
+        temporario = self.caminho_snapshot + ".tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            json.dump(dados, arquivo, separators=(",", ":"))
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, self.caminho_snapshot)
+        self._desde_snapshot = 0
+
+    def fechar(self):
+        if self._arquivo is not None:
+            self._arquivo.close()
+            self._arquivo = None
+
+
+def reproduzir(caminho: str):
+    """Reaplica um log inteiro em um estado vazio e mede o tempo gasto."""
+    estado = EstadoPassagens()
+    inicio = time.perf_counter()
+    quantidade = 0
+    for evento, _ in ler_eventos(caminho):
+        estado.aplicar(evento)
+        quantidade += 1
+    duracao = time.perf_counter() - inicio
+    return estado, quantidade, duracao
+
+
+# Uso: python eventos.py replay eventos/passagens.log
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "replay":
+        print("Uso: python eventos.py replay <arquivo de log>")
+        sys.exit(1)
+
+    estado, quantidade, duracao = reproduzir(sys.argv[2])
+    taxa = quantidade / duracao if duracao else 0
+    print(f"{quantidade} eventos reproduzidos em {duracao:.3f}s ({taxa:.0f} eventos/s), {len(estado.passagens)} passagens")
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request, Form, Depends, HTTPException, Response, Path
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 from sqlalchemy.orm import Session, joinedload
@@ -9,17 +9,122 @@ from datetime import datetime, timedelta
 from fastapi import Body
 
 from time import time
+from contextlib import asynccontextmanager
 from database import get_db, SessionLocal, engine
 
 from configs import adicionar_coluna_tempo
 from calculos import contar_registros
+from arquivamento import arquivar_enduro, concluir_arquivamentos, enduro_finalizado, listar_arquivados, get_db_arquivo
+from previsoes import (
+    agendar_competidor, agendar_checkpoint, deslocar_checkpoint, deslocar_enduro,
+    remover_previsoes_enduro, garantir_previsoes, proximos, hora_para_segundos,
+)
+from eventos import RegistroEventos
+from middlewares import FlashMiddleware, CompressaoMiddleware
+from perfil import PerfilMiddleware, RotaPerfilada, exigir_token, instrumentar_templates, listar_perfis, carregar_perfil, para_collapsed, para_speedscope
 
 # Configuração do Jinja2Templates
 templates = Jinja2Templates(directory="templates")
+instrumentar_templates(templates)
 
-app = FastAPI()
+# Log de eventos das passagens; o estado derivado é recuperado na inicialização
+registro = RegistroEventos()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db = SessionLocal()
+    try:
+        concluir_arquivamentos(db)
+        registro.recuperar(db)
+    finally:
+        db.close()
+    yield
+    registro.snapshot()
+    registro.fechar()
+
+
+app = FastAPI(lifespan=lifespan)
+# As rotas marcam a thread que as executa para o profiling sob demanda
+app.router.route_class = RotaPerfilada
+
+
+# Tamanho mínimo de cada pedaço enviado pelas respostas em streaming
+STREAM_CHUNK_SIZE = 8192
+
+# Quantidade de linhas buscadas por vez nas listas renderizadas em streaming
+STREAM_YIELD_PER = 200
+
+
+class LinhasEmLotes:
+    """
+    Itera as linhas de uma consulta em lotes de STREAM_YIELD_PER, paginando
+    pelo id, cada lote em uma sessão própria que é fechada logo em seguida.
+
+    Um cursor aberto durante todo o streaming manteria a transação de leitura
+    do SQLite enquanto o cliente baixa a página, e no journal "delete" isso
+    bloqueia todas as gravações (um celular lento travaria a cronometragem).
+    O banco não usa WAL porque o arquivamento depende de o commit entre o
+    banco principal e o arquivo anexado ser atômico, o que o WAL não garante.
+    """
+
+    def __init__(self, consulta, coluna_id):
+        self.consulta = consulta  # Recebe a sessão e retorna a query, sem ordenação nem limite
+        self.coluna_id = coluna_id
+        self.iniciada = False  # Passa a True quando o template começa a consumir as linhas
+
+    def __iter__(self):
+        self.iniciada = True
+        ultimo_id = None
+        while True:
+            with SessionLocal() as db:
+                query = self.consulta(db)
+                if ultimo_id is not None:
+                    query = query.filter(self.coluna_id > ultimo_id)
+                lote = query.order_by(self.coluna_id).limit(STREAM_YIELD_PER).all()
+            yield from lote
+            if len(lote) < STREAM_YIELD_PER:
+                return
+            ultimo_id = getattr(lote[-1], self.coluna_id.key)
+
+
+def stream_template(name: str, context: dict, linhas: LinhasEmLotes = None) -> StreamingResponse:
+    """
+    Renderiza o template em pedaços com o generate() do Jinja. O texto gerado
+    até o template começar a consumir as linhas é enviado de uma vez, para o
+    navegador já mostrar o cabeçalho; depois disso a página segue em pedaços
+    de STREAM_CHUNK_SIZE. Os trechos do Jinja têm poucos bytes, e enviá-los
+    um a um custaria uma ida ao threadpool e um envio ASGI por trecho.
+    """
+    template = templates.get_template(name)
+
+    def gerar():
+        buffer = []
+        tamanho = 0
+        cabecalho_enviado = linhas is None
+        for trecho in template.generate(context):
+            buffer.append(trecho)
+            tamanho += len(trecho)
+            if tamanho >= STREAM_CHUNK_SIZE or (not cabecalho_enviado and linhas.iniciada):
+                cabecalho_enviado = True
+                yield "".join(buffer)
+                buffer = []
+                tamanho = 0
+        if buffer:
+            yield "".join(buffer)
+
+    return StreamingResponse(gerar(), media_type="text/html")
+
+
+def competidores_em_lotes(enduro_id: int) -> LinhasEmLotes:
+    """Competidores do enduro, já com a categoria, na ordem de inscrição."""
+    return LinhasEmLotes(
+        lambda db: db.query(Competitor)
+        .options(joinedload(Competitor.category))
+        .filter(Competitor.enduro_id == enduro_id),
+        Competitor.id,
+    )
+
         
 def seconds_to_hms(seconds: float) -> str:
     """Converte segundos para o formato HH:MM:SS."""
@@ -42,16 +147,36 @@ def get_flash_message(request: Request):
     flash_category = request.cookies.get("flash_category")
     return flash_message, flash_category
 
-# Middleware para limpar mensagens flash após exibi-las
-@app.middleware("http")
-async def clear_flash_messages(request: Request, call_next):
-    response = await call_next(request)
-    
-    if request.cookies.get("flash_message"):
-        response.delete_cookie("flash_message")
-        response.delete_cookie("flash_category")
-    
-    return response
+# Middlewares ASGI: limpeza das mensagens flash após exibi-las e compressão das respostas
+app.add_middleware(FlashMiddleware)
+app.add_middleware(CompressaoMiddleware, minimo=500)
+
+# Profiling opcional por requisição (cabeçalho X-Perfil com o PERFIL_TOKEN ou PERFIL_TAXA), registrado por último para envolver toda a pilha
+app.add_middleware(PerfilMiddleware)
+
+# Rotas de administração dos perfis gravados
+@app.get("/admin/perfis/", response_class=JSONResponse, dependencies=[Depends(exigir_token)])
+def list_perfis():
+    return listar_perfis()
+
+@app.get("/admin/perfis/{perfil_id}/", dependencies=[Depends(exigir_token)])
+def download_perfil(perfil_id: str, formato: str = "speedscope"):
+    dados = carregar_perfil(perfil_id)
+    if dados is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+
+    if formato == "collapsed":
+        return Response(
+            content=para_collapsed(dados),
+            media_type="text/plain",
+            headers={"Content-Disposition": f'attachment; filename="{perfil_id}.collapsed.txt"'},
+        )
+    if formato == "speedscope":
+        return JSONResponse(
+            content=para_speedscope(dados),
+            headers={"Content-Disposition": f'attachment; filename="{perfil_id}.speedscope.json"'},
+        )
+    raise HTTPException(status_code=400, detail="Formato inválido, use speedscope ou collapsed")
 
 # Página inicial
 @app.get("/", response_class=HTMLResponse)
@@ -123,11 +248,16 @@ def update_enduro(
     if not db_enduro:
         raise HTTPException(status_code=404, detail="Enduro não encontrado")
     
+    # Diferença na hora de largada, usada para deslocar as previsões de passagem
+    delta = hora_para_segundos(hora_largada) - hora_para_segundos(db_enduro.hora_largada)
+
     db_enduro.name = name
     db_enduro.location = location
     db_enduro.date = date
     db_enduro.hora_largada = hora_largada
+    deslocar_enduro(db, enduro_id, delta)
    
+    # Um único commit para o enduro e as previsões deslocadas
     db.commit()
     db.refresh(db_enduro)
     
@@ -146,7 +276,7 @@ def delete_enduro(
     if not db_enduro:
         raise HTTPException(status_code=404, detail="Enduro não encontrado")
     
-    
+    remover_previsoes_enduro(db, enduro_id)
     db.delete(db_enduro)
     db.commit()    
    
@@ -155,6 +285,53 @@ def delete_enduro(
     set_flash_message(response, "Enduro excluído com sucesso!", "success")
     return RedirectResponse(url="/enduros/", status_code=303)
 
+# Rota para arquivar um enduro finalizado em um arquivo SQLite próprio
+@app.post("/enduros/{enduro_id}/arquivar/", response_class=RedirectResponse)
+def archive_enduro(
+    enduro_id: int,
+    db: Session = Depends(get_db),
+    response: Response = Response
+):
+    enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
+    if not enduro:
+        raise HTTPException(status_code=404, detail="Enduro não encontrado")
+    if not enduro_finalizado(enduro):
+        raise HTTPException(status_code=409, detail="Só é possível arquivar um enduro depois do dia da prova")
+
+    # O evento vai para o log antes de o banco ser alterado
+    registro.registrar("arquivamento", enduro_id=enduro_id)
+    try:
+        arquivar_enduro(db, enduro_id)
+    except Exception:
+        # O enduro continua no banco: as passagens dele voltam para o estado
+        registro.restaurar_enduro(db, enduro_id)
+        raise
+
+    set_flash_message(response, "Enduro arquivado com sucesso!", "success")
+    return RedirectResponse(url="/arquivos/", status_code=303)
+
+# Rotas para visualizar enduros arquivados
+@app.get("/arquivos/", response_class=HTMLResponse)
+def list_arquivados(request: Request):
+    enduros = listar_arquivados()
+    return templates.TemplateResponse("list_enduros.html", {"request": request, "enduros": enduros, "arquivado": True})
+
+@app.get("/arquivos/{enduro_id}/", response_class=HTMLResponse)
+def arquivado_detail(enduro_id: int, request: Request, db: Session = Depends(get_db_arquivo)):
+    enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
+    if not enduro:
+        raise HTTPException(status_code=404, detail="Enduro não encontrado")
+    return templates.TemplateResponse("enduro_detail.html", {"request": request, "enduro": enduro, "arquivado": True})
+
+@app.get("/arquivos/{enduro_id}/competitors/", response_class=HTMLResponse)
+def list_competitors_arquivados(enduro_id: int, request: Request, db: Session = Depends(get_db_arquivo)):
+    enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
+    if not enduro:
+        raise HTTPException(status_code=404, detail="Enduro não encontrado")
+
+    competitors = db.query(Competitor).options(joinedload(Competitor.category)).filter(Competitor.enduro_id == enduro_id).all()
+    return templates.TemplateResponse("list_competitors.html", {"request": request, "enduro": enduro, "competitors": competitors, "arquivado": True})
+
 # Rotas para ver adicionar Competidores
 @app.get("/enduros/{enduro_id}/competitors/create", response_class=HTMLResponse)
 def create_competitor_form(request: Request, enduro_id: int, db: Session = Depends(get_db)):
@@ -180,6 +357,8 @@ def create_competitor(
 ):
     db_competitor = Competitor(name=name, enduro_id = enduro_id, placa=placa, categories_id = categories_id)
     db.add(db_competitor)
+    db.flush()  # Gera o id usado nas previsões
+    agendar_competidor(db, db_competitor)
     db.commit()
     db.refresh(db_competitor)
     
@@ -242,7 +421,7 @@ def delete_enduro(
     if not db_enduro:
         raise HTTPException(status_code=404, detail="Enduro não encontrado")
     
-    
+    remover_previsoes_enduro(db, enduro_id)
     db.delete(db_enduro)
     db.commit()    
    
@@ -255,13 +434,15 @@ def delete_enduro(
 
 @app.get("/enduros/{enduro_id}/competitors/", response_class=HTMLResponse) 
 def list_competitors(enduro_id: int, request: Request, db: Session = Depends(get_db)):
-    
     enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
     if not enduro:
         raise HTTPException(status_code=404, detail="Enduro não encontrado")
     
-    competitors = db.query(Competitor).options(joinedload(Competitor.category)).filter(Competitor.enduro_id == enduro_id).all()
-    return templates.TemplateResponse("list_competitors.html", {"request": request, "enduro": enduro, "competitors": competitors})# Rotas para Checkpoints
+    # As linhas são buscadas aos poucos, em transações curtas, enquanto o template é enviado
+    competitors = competidores_em_lotes(enduro_id)
+    return stream_template("list_competitors.html", {"request": request, "enduro": enduro, "competitors": competitors}, competitors)
+
+# Rotas para Checkpoints
 
 #Criando Checkpoint 
 @app.get("/enduros/{enduro_id}/checkpoints/create/", response_class=HTMLResponse)
@@ -290,6 +471,8 @@ def create_checkpoint(
         # Cria o checkpoint
         db_checkpoint = Checkpoint(checkpoint_name=checkpoint_name, time=tempo, enduro_id=enduro_id)
         db.add(db_checkpoint)
+        db.flush()  # Gera o id usado nas previsões
+        agendar_checkpoint(db, db_checkpoint)
         db.commit()
         db.refresh(db_checkpoint)
 
@@ -336,10 +519,42 @@ def list_checkpoints(request: Request, enduro_id: int, db: Session = Depends(get
 
 
 
+# Rota para alterar o tempo de um checkpoint (o nome não muda, pois dá nome à coluna em "tempos")
+@app.post("/enduros/{enduro_id}/checkpoints/{checkpoint_id}/update/", response_class=RedirectResponse)
+def update_checkpoint(
+    enduro_id: int,
+    checkpoint_id: int,
+    tempo: float = Form(...),
+    db: Session = Depends(get_db),
+    response: Response = Response
+):
+    db_checkpoint = db.query(Checkpoint).filter(
+        Checkpoint.id == checkpoint_id,
+        Checkpoint.enduro_id == enduro_id,
+    ).first()
+    if not db_checkpoint:
+        raise HTTPException(status_code=404, detail="Checkpoint não encontrado")
+
+    delta = tempo - db_checkpoint.time
+    db_checkpoint.time = tempo
+
+    # Desloca as previsões já calculadas em vez de recalcular o checkpoint inteiro
+    deslocar_checkpoint(db, checkpoint_id, delta)
+    db.commit()
+
+    set_flash_message(response, "Checkpoint atualizado com sucesso!", "success")
+    return RedirectResponse(url=f"/enduros/{enduro_id}/checkpoints/", status_code=303)
+
+
+def segundos_agora() -> float:
+    agora = datetime.now()
+    return agora.hour * 3600 + agora.minute * 60 + agora.second
+
+
 #Rota para lançamento dos tempos
 
 @app.get("/enduros/{enduro_id}/checkpoints/{checkpoint_id}/competitors/", response_class=HTMLResponse)
-def list_competitors_for_checkpoint(enduro_id: int, checkpoint_id: int, request: Request, db: Session = Depends(get_db)):
+def list_competitors_for_checkpoint(enduro_id: int, checkpoint_id: int, request: Request, minutos: int = None, db: Session = Depends(get_db)):
     
     # Busca o checkpoint no banco de dados
     enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
@@ -350,59 +565,99 @@ def list_competitors_for_checkpoint(enduro_id: int, checkpoint_id: int, request:
     if not checkpoint:
         raise HTTPException(status_code=404, detail="Checkpoint não encontrado")
     
-    # Busca os competidores associados ao enduro do checkpoint
-    competitors = db.query(Competitor).filter(Competitor.enduro_id == checkpoint.enduro_id).all()
-    
-    
+    # Competidores na ordem prevista de passagem; com ?minutos=N, só quem passa nos próximos N minutos
+    garantir_previsoes(db, checkpoint)
+    db.commit()
+    inicio = segundos_agora() if minutos is not None else None
+    previsoes = proximos(db, checkpoint_id, inicio, minutos)
     
     return templates.TemplateResponse("list_competitors_for_checkpoint.html", {
         "request": request,
         "enduro": enduro,
-        "competitor": competitors,
+        "competitor": [previsao.competitor for previsao in previsoes],
         "checkpoints": checkpoint,
-        "competitors": [{"hora_largada": competitor.hora_largada.strftime("%H:%M")} for competitor in competitors]
+        "competitors": [
+            {
+                "id": previsao.competitor_id,
+                "name": previsao.competitor.name,
+                "placa": previsao.competitor.placa,
+                "hora_largada": seconds_to_hms(previsao.hora_prevista - checkpoint.time)[:5],
+                "hora_prevista": seconds_to_hms(previsao.hora_prevista),
+            }
+            for previsao in previsoes
+        ],
+        "minutos": minutos,
     })
+
+# API com os competidores previstos para passar em um checkpoint
+@app.get("/api/checkpoints/{checkpoint_id}/proximos/", response_class=JSONResponse)
+def api_proximos(checkpoint_id: int, minutos: int = 10, a_partir: str = None, db: Session = Depends(get_db)):
+    checkpoint = db.query(Checkpoint).filter(Checkpoint.id == checkpoint_id).first()
+    if not checkpoint:
+        raise HTTPException(status_code=404, detail="Checkpoint não encontrado")
+
+    garantir_previsoes(db, checkpoint)
+    db.commit()
+    inicio = hora_para_segundos(a_partir) if a_partir else segundos_agora()
+    return [
+        {
+            "competitor_id": previsao.competitor_id,
+            "name": previsao.competitor.name,
+            "placa": previsao.competitor.placa,
+            "ordem_largada": previsao.ordem_largada,
+            "hora_prevista": seconds_to_hms(previsao.hora_prevista),
+        }
+        for previsao in proximos(db, checkpoint_id, inicio, minutos)
+    ]
     
    
 
+# Rotas das passagens registradas no log de eventos
+@app.get("/api/checkpoints/{checkpoint_id}/passagens/", response_class=JSONResponse)
+def api_passagens(checkpoint_id: int):
+    return registro.do_checkpoint(checkpoint_id)
+
 @app.post("/enduros/{enduro_id}/checkpoints/{checkpoint_id}/competitors/{competitor_id}/update/")
 def update_tempos(
     enduro_id: int,
     request: Request,
     competitor_id: int,
     checkpoint_id: int,
-    hora_largdada: str,
-    checkpoint_name: str, 
+    largada: float = Form(...),  # Horário da passagem, em segundos
     db: Session = Depends(get_db),
     response: Response = Response
 ):
-    # Recuperar o enduro para pegar o horário de largada
     enduro = db.query(Enduro).filter(Enduro.id == enduro_id).first()
 
     if not enduro:
         set_flash_message(response, "Enduro não encontrado.", "error")
         return RedirectResponse(url=f"/enduros/", status_code=303)
 
-    # Converter a hora de largada do enduro em datetime e adicionar 1 minuto
-    hora_largada_enduro = datetime.combine(datetime.today(), enduro.hora_largada)
-    hora_largada_competidor = hora_largada_enduro + timedelta(minutes=1)
-
-    # Criar o competidor com a hora de largada calculada
-    db_tempo = Tempo(
-        enduro_id= enduro_id,
-        competitor_id=competitor_id,
+    # Uma passagem por competidor em cada checkpoint; um novo lançamento substitui o anterior
+    db_tempo = db.query(Tempo).filter(
+        Tempo.competitor_id == competitor_id,
+        Tempo.checkpoint_id == checkpoint_id,
+    ).first()
+    if not db_tempo:
+        db_tempo = Tempo(enduro_id=enduro_id, competitor_id=competitor_id, checkpoint_id=checkpoint_id)
+        db.add(db_tempo)
+    db_tempo.largada = largada
+
+    # Grava a mutação no log de eventos antes do commit; se o processo cair
+    # entre os dois, a recuperação regrava a passagem em "tempos"
+    registro.registrar(
+        "passagem",
+        enduro_id=enduro_id,
         checkpoint_id=checkpoint_id,
-        hora_largada=hora_largada_competidor,
-        checkpoint_name=checkpoint_name
-        
+        competitor_id=competitor_id,
+        largada=largada,
     )
-    
-    db.add(db_tempo)
+
     db.commit()
     db.refresh(db_tempo)
     
-    set_flash_message(response, "Competidor adicionado com sucesso!", "success")
-    return RedirectResponse(url=f"/enduros/", status_code=303)
+    set_flash_message(response, "Tempo registrado com sucesso!", "success")
+    return RedirectResponse(url=f"/enduros/{enduro_id}/checkpoints/{checkpoint_id}/competitors/", status_code=303)
 
 
 
@@ -513,31 +768,28 @@ def list_largada(enduro_id: int, request: Request, db: Session = Depends(get_db)
     if not enduro:
         raise HTTPException(status_code=404, detail="Enduro não encontrado")
 
-    # Busca os competidores associados ao enduro
-    competitors = db.query(Competitor).filter(Competitor.enduro_id == enduro_id).all()
+    # Busca os competidores associados ao enduro, já com a categoria, aos poucos
+    competitors = competidores_em_lotes(enduro_id)
 
-    # Calcula a hora de largada para cada competidor
-    largada_list = []
     hora_largada_base = datetime.strptime(enduro.hora_largada, "%H:%M")  # Converte a hora de largada base para um objeto datetime
 
-    for i, competitor in enumerate(competitors):
-        # Adiciona i minutos à hora de largada base
-        hora_largada_competitor = (hora_largada_base + timedelta(minutes=i)).strftime("%H:%M")
-        
-        # Busca o nome da categoria do competidor
-        category = db.query(Category).filter(Category.id == competitor.categories_id).first()
-        category_name = category.name if category else "Sem categoria"
+    # Calcula a hora de largada de cada competidor conforme o template consome a lista
+    def largada_list():
+        for i, competitor in enumerate(competitors):
+            # Adiciona i minutos à hora de largada base
+            hora_largada_competitor = (hora_largada_base + timedelta(minutes=i)).strftime("%H:%M")
+            category_name = competitor.category.name if competitor.category else "Sem categoria"
 
-        # Adiciona o competidor à lista de largada
-        largada_list.append({
-            "name": competitor.name,
-            "category": category_name,
-            "hora_largada": hora_largada_competitor
-        })
+            yield {
+                "name": competitor.name,
+                "category": category_name,
+                "hora_largada": hora_largada_competitor
+            }
 
-    return templates.TemplateResponse(
+    return stream_template(
         "list_largada.html",
-        {"request": request, "enduro": enduro, "largada_list": largada_list}
+        {"request": request, "enduro": enduro, "largada_list": largada_list()},
+        competitors
     )
     
     
@@ -0,0 +1,224 @@
+import gzip
+import hashlib
+import zlib
+from collections import OrderedDict
+
+from starlette.datastructures import MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli é opcional; sem ele só gzip é oferecido
+    brotli = None
+
+
+# Cabeçalhos que apagam os cookies de mensagem flash no navegador
+_APAGAR_FLASH = [
+    (b"set-cookie", f'{nome}=""; expires=Thu, 01 Jan 1970 00:00:00 GMT; Max-Age=0; Path=/; SameSite=lax'.encode())
+    for nome in ("flash_message", "flash_category")
+]
+
+# Tipos de conteúdo que valem a pena comprimir
+_TIPOS_COMPRIMIVEIS = (b"text/", b"application/json", b"application/javascript", b"application/xml", b"image/svg+xml")
+
+
+class FlashMiddleware:
+    """Apaga as mensagens flash depois que a requisição que as exibiu é respondida."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _tem_flash(scope):
+            await self.app(scope, receive, send)
+            return
+
+        async def enviar(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                # Não apaga uma mensagem nova definida por esta mesma resposta
+                if not any(nome == b"set-cookie" and valor.startswith(b"flash_message=") for nome, valor in headers):
+                    message["headers"] = headers + _APAGAR_FLASH
+            await send(message)
+
+        await self.app(scope, receive, enviar)
+
+
+def _tem_flash(scope) -> bool:
+    for nome, valor in scope["headers"]:
+        if nome == b"cookie" and b"flash_message=" in valor:
+            return True
+    return False
+
+
+def _escolher_codificacao(scope):
+    """Escolhe br ou gzip conforme o Accept-Encoding do cliente."""
+    aceitas = set()
+    for nome, valor in scope["headers"]:
+        if nome == b"accept-encoding":
+            for item in valor.decode("latin-1").lower().split(","):
+                codificacao, _, parametros = item.strip().partition(";")
+                if parametros.replace(" ", "") not in ("q=0", "q=0.0"):
+                    aceitas.add(codificacao.strip())
+    if brotli is not None and "br" in aceitas:
+        return "br"
+    if "gzip" in aceitas:
+        return "gzip"
+    return None
+
+
+class CompressaoMiddleware:
+    """
+    Comprime respostas com brotli ou gzip conforme o cliente aceitar.
+    Respostas pequenas não são comprimidas; respostas completas repetidas
+    são servidas de um cache LRU já comprimido, limitado em itens e em
+    bytes, e respostas em streaming são comprimidas pedaço a pedaço, com um
+    flush a cada fluxo_minimo bytes de entrada.
+    """
+
+    def __init__(
+        self,
+        app,
+        minimo: int = 500,
+        nivel_gzip: int = 6,
+        nivel_brotli: int = 5,
+        cache_max: int = 256,
+        cache_bytes: int = 4 * 1024 * 1024,
+        cache_corpo_max: int = 512 * 1024,
+        fluxo_minimo: int = 4096,
+    ):
+        self.app = app
+        self.minimo = minimo
+        self.nivel_gzip = nivel_gzip
+        self.nivel_brotli = nivel_brotli
+        self.cache_max = cache_max  # Quantidade máxima de respostas no cache
+        self.cache_bytes = cache_bytes  # Total máximo de bytes comprimidos no cache
+        self.cache_corpo_max = cache_corpo_max  # Corpos maiores que isso não são guardados
+        self.fluxo_minimo = fluxo_minimo  # Bytes de entrada acumulados antes de cada flush em streaming
+        self.cache = OrderedDict()
+        self._cache_total = 0
+
+    async def __call__(self, scope, receive, send):
+        codificacao = _escolher_codificacao(scope) if scope["type"] == "http" else None
+        if codificacao is None:
+            await self.app(scope, receive, send)
+            return
+        await _RespostaComprimida(self, codificacao, send).executar(scope, receive)
+
+    def comprimir(self, codificacao: str, corpo: bytes) -> bytes:
+        # Páginas grandes mudam a cada passagem registrada; guardá-las só ocuparia memória
+        if len(corpo) > self.cache_corpo_max:
+            return self._comprimir(codificacao, corpo)
+
+        chave = (codificacao, hashlib.sha1(corpo).digest())
+        comprimido = self.cache.get(chave)
+        if comprimido is not None:
+            self.cache.move_to_end(chave)
+            return comprimido
+
+        comprimido = self._comprimir(codificacao, corpo)
+
+        self.cache[chave] = comprimido
+        self._cache_total += len(comprimido)
+        while self.cache and (len(self.cache) > self.cache_max or self._cache_total > self.cache_bytes):
+            _, removido = self.cache.popitem(last=False)
+            self._cache_total -= len(removido)
+        return comprimido
+
+    def _comprimir(self, codificacao: str, corpo: bytes) -> bytes:
+        if codificacao == "br":
+            return brotli.compress(corpo, quality=self.nivel_brotli)
+        return gzip.compress(corpo, compresslevel=self.nivel_gzip, mtime=0)
+
+    def compressor(self, codificacao: str):
+        """Retorna funções (processar, descarregar, finalizar) para comprimir um corpo em streaming."""
+        if codificacao == "br":
+            compressor = brotli.Compressor(quality=self.nivel_brotli)
+            return compressor.process, compressor.flush, compressor.finish
+        compressor = zlib.compressobj(self.nivel_gzip, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, (lambda: compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+
+class _RespostaComprimida:
+    def __init__(self, middleware: CompressaoMiddleware, codificacao: str, send):
+        self.middleware = middleware
+        self.codificacao = codificacao
+        self.send = send
+        self.inicio = None
+        self.comprimir = False
+        self.streaming = False
+        self.processar = None
+        self.descarregar = None
+        self.finalizar = None
+        self.pendente = 0  # Bytes de entrada desde o último flush
+
+    async def executar(self, scope, receive):
+        await self.middleware.app(scope, receive, self.enviar)
+
+    async def enviar(self, message):
+        tipo = message["type"]
+        if tipo == "http.response.start":
+            # Segura o início até saber o tamanho do corpo
+            self.inicio = message
+            headers = MutableHeaders(raw=message.setdefault("headers", []))
+            self.comprimir = (
+                "content-encoding" not in headers
+                and headers.get("content-type", "").encode("latin-1").startswith(_TIPOS_COMPRIMIVEIS)
+            )
+            return
+
+        if tipo != "http.response.body":
+            await self.send(message)
+            return
+
+        if self.inicio is not None:
+            inicio, self.inicio = self.inicio, None
+            await self._primeiro_corpo(inicio, message)
+            return
+
+        if self.streaming:
+            mais = message.get("more_body", False)
+            message["body"] = self._comprimir_pedaco(message.get("body", b""), mais, self.middleware.fluxo_minimo)
+            if mais and not message["body"]:
+                return
+        await self.send(message)
+
+    def _comprimir_pedaco(self, corpo: bytes, mais: bool, minimo: int) -> bytes:
+        # Cada flush parcial custa bytes de sincronização; com pedaços pequenos a
+        # saída ficaria maior que a entrada, então eles se acumulam no compressor
+        dados = self.processar(corpo)
+        self.pendente += len(corpo)
+        if not mais:
+            dados += self.finalizar()
+        elif self.pendente >= minimo:
+            # O flush parcial deixa o navegador mostrar o que já chegou
+            dados += self.descarregar()
+            self.pendente = 0
+        return dados
+
+    async def _primeiro_corpo(self, inicio, message):
+        corpo = message.get("body", b"")
+        mais = message.get("more_body", False)
+
+        if not self.comprimir or (not mais and len(corpo) < self.middleware.minimo):
+            await self.send(inicio)
+            await self.send(message)
+            return
+
+        headers = MutableHeaders(raw=inicio["headers"])
+        headers["content-encoding"] = self.codificacao
+        headers.add_vary_header("Accept-Encoding")
+
+        if mais:
+            # Resposta em streaming: comprime cada pedaço sem esperar o corpo todo
+            self.streaming = True
+            self.processar, self.descarregar, self.finalizar = self.middleware.compressor(self.codificacao)
+            if "content-length" in headers:
+                del headers["content-length"]
+            # O primeiro pedaço (o cabeçalho da página) sai sempre, qualquer que seja o tamanho
+            message["body"] = self._comprimir_pedaco(corpo, mais, 0)
+        else:
+            message["body"] = self.middleware.comprimir(self.codificacao, corpo)
+            headers["content-length"] = str(len(message["body"]))
+
+        await self.send(inicio)
+        await self.send(message)
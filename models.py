@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Time
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Time, Index
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from pydantic import BaseModel
@@ -9,6 +9,8 @@ from database import Base, engine
 
 class Enduro(Base):
     __tablename__ = "enduros"
+    # Sem AUTOINCREMENT o SQLite reutilizaria o id de um enduro arquivado, colidindo com o arquivo dele
+    __table_args__ = {"sqlite_autoincrement": True}
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     location = Column(String)
@@ -72,6 +74,24 @@ class Category(Base):
     competitors = relationship("Competitor", back_populates="category")
 
 
+class Previsao(Base):
+    """Horário previsto de passagem de cada competidor em cada checkpoint."""
+    __tablename__ = "previsoes"
+    __table_args__ = (
+        # Permite buscar "quem passa nos próximos N minutos" por intervalo
+        Index("ix_previsoes_checkpoint_hora", "checkpoint_id", "hora_prevista"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    enduro_id = Column(Integer, ForeignKey("enduros.id"), index=True)
+    checkpoint_id = Column(Integer, ForeignKey("checkpoints.id"))
+    competitor_id = Column(Integer, ForeignKey("competitors.id"), index=True)
+    ordem_largada = Column(Integer)  # Posição do competidor na lista de largada (1 minuto por posição)
+    hora_prevista = Column(Float)  # Segundos desde a meia-noite
+
+    checkpoint = relationship("Checkpoint")
+    competitor = relationship("Competitor")
+
+
 # Classes Pydantic para validação
 class EnduroUpdate(BaseModel):
     name: Optional[str] = None
@@ -0,0 +1,414 @@
+import contextvars
+import functools
+import hmac
+import inspect
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from database import engine
+
+
+# Configuração do profiling por requisição (desligado por padrão)
+PERFIS_DIR = os.environ.get("PERFIL_DIR", "./perfis")
+PERFIL_MAX = int(os.environ.get("PERFIL_MAX", "50"))  # Quantidade máxima de perfis guardados em disco
+PERFIL_TAXA = float(os.environ.get("PERFIL_TAXA", "0"))  # Fração das requisições perfiladas por amostragem
+PERFIL_INTERVALO = 0.001  # Intervalo entre amostras da pilha Python, em segundos
+PERFIL_HEADER = b"x-perfil"
+# Segredo exigido no cabeçalho X-Perfil e nas rotas de administração; sem ele o cabeçalho é ignorado
+PERFIL_TOKEN = os.environ.get("PERFIL_TOKEN", "")
+
+# Perfil da requisição em andamento; copiado para as threads que atendem a requisição
+perfil_atual = contextvars.ContextVar("perfil_atual", default=None)
+
+_perfis_ativos = 0
+_lock = threading.Lock()
+
+_ID_VALIDO = re.compile(r"^[0-9a-f-]+$")
+
+
+class Perfil:
+    """Dados coletados durante uma requisição perfilada."""
+
+    def __init__(self, method: str, path: str):
+        self.id = f"{int(time.time() * 1000):013d}-{random.getrandbits(32):08x}"
+        self.method = method
+        self.path = path
+        self.status = None
+        self.inicio = time.time()
+        self.inicio_perf = time.perf_counter()
+        self.duracao = 0.0
+        self.amostras = Counter()
+        self.sql = []
+        self.templates = []
+        # Threads que estão executando esta requisição agora (ident -> profundidade)
+        self.threads = {}
+        self._threads_lock = threading.Lock()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._amostrar, name=f"perfil-{self.id}", daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def parar(self):
+        """Encerra a medição sem esperar a thread de amostragem terminar."""
+        self.duracao = time.perf_counter() - self.inicio_perf
+        self._parar.set()
+
+    def aguardar(self):
+        self._thread.join()
+
+    @contextmanager
+    def executando(self):
+        """Marca a thread atual como ocupada com esta requisição enquanto o bloco roda."""
+        ident = threading.get_ident()
+        with self._threads_lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            with self._threads_lock:
+                if self.threads[ident] == 1:
+                    del self.threads[ident]
+                else:
+                    self.threads[ident] -= 1
+
+    def registrar(self, lista: list, nome: str, inicio: float, fim: float):
+        lista.append({
+            "nome": nome,
+            "inicio": inicio - self.inicio_perf,
+            "duracao": fim - inicio,
+        })
+
+    def _amostrar(self):
+        """Amostra periodicamente a pilha Python das threads que executam esta requisição."""
+        while not self._parar.wait(PERFIL_INTERVALO):
+            with self._threads_lock:
+                idents = list(self.threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.amostras[_formatar_pilha(frame)] += 1
+
+    def para_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "inicio": self.inicio,
+            "duracao": self.duracao,
+            "intervalo": PERFIL_INTERVALO,
+            "amostras": dict(self.amostras),
+            "sql": self.sql,
+            "templates": self.templates,
+        }
+
+
+def _formatar_pilha(frame) -> str:
+    """Monta a pilha no formato "raiz;...;folha"."""
+    nomes = []
+    while frame is not None:
+        codigo = frame.f_code
+        nomes.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+        frame = frame.f_back
+    nomes.reverse()
+    return ";".join(nomes)
+
+
+# Eventos do SQLAlchemy para medir cada comando SQL
+def _antes_sql(conn, cursor, statement, parameters, context, executemany):
+    if perfil_atual.get() is not None:
+        conn.info.setdefault("perfil_inicio_sql", []).append(time.perf_counter())
+
+
+def _depois_sql(conn, cursor, statement, parameters, context, executemany):
+    perfil = perfil_atual.get()
+    inicios = conn.info.get("perfil_inicio_sql")
+    if perfil is None or not inicios:
+        return
+    perfil.registrar(perfil.sql, " ".join(statement.split()), inicios.pop(), time.perf_counter())
+
+
+def _ativar():
+    """Liga os eventos de SQL somente enquanto houver alguma requisição perfilada."""
+    global _perfis_ativos
+    with _lock:
+        _perfis_ativos += 1
+        if _perfis_ativos == 1:
+            event.listen(engine, "before_cursor_execute", _antes_sql)
+            event.listen(engine, "after_cursor_execute", _depois_sql)
+
+
+def _desativar():
+    global _perfis_ativos
+    with _lock:
+        _perfis_ativos -= 1
+        if _perfis_ativos == 0:
+            event.remove(engine, "before_cursor_execute", _antes_sql)
+            event.remove(engine, "after_cursor_execute", _depois_sql)
+
+
+def instrumentar_templates(templates):
+    """Faz os templates registrarem o tempo de renderização no perfil da requisição."""
+    classe_original = templates.env.template_class
+
+    class TemplatePerfilado(classe_original):
+        def render(self, *args, **kwargs):
+            perfil = perfil_atual.get()
+            if perfil is None:
+                return super().render(*args, **kwargs)
+            inicio = time.perf_counter()
+            try:
+                return super().render(*args, **kwargs)
+            finally:
+                perfil.registrar(perfil.templates, self.name, inicio, time.perf_counter())
+
+        def generate(self, *args, **kwargs):
+            perfil = perfil_atual.get()
+            if perfil is None:
+                yield from super().generate(*args, **kwargs)
+                return
+            inicio = time.perf_counter()
+            trechos = super().generate(*args, **kwargs)
+            try:
+                # Cada pedaço pode ser gerado em uma thread diferente do threadpool
+                while True:
+                    with perfil.executando():
+                        trecho = next(trechos, None)
+                    if trecho is None:
+                        break
+                    yield trecho
+            finally:
+                perfil.registrar(perfil.templates, self.name, inicio, time.perf_counter())
+
+    templates.env.template_class = TemplatePerfilado
+
+
+def _perfilar_endpoint(endpoint):
+    """Envolve o endpoint para que a thread que o executa entre na amostragem."""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def envolvido(*args, **kwargs):
+            perfil = perfil_atual.get()
+            if perfil is None:
+                return await endpoint(*args, **kwargs)
+            with perfil.executando():
+                return await endpoint(*args, **kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def envolvido(*args, **kwargs):
+            perfil = perfil_atual.get()
+            if perfil is None:
+                return endpoint(*args, **kwargs)
+            with perfil.executando():
+                return endpoint(*args, **kwargs)
+    return envolvido
+
+
+class RotaPerfilada(APIRoute):
+    """Rota cujo endpoint é amostrado quando a requisição está sendo perfilada."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _perfilar_endpoint(endpoint), **kwargs)
+
+
+def token_valido(valor) -> bool:
+    if not PERFIL_TOKEN or not valor:
+        return False
+    # Compara em UTF-8: o token da query string pode ter qualquer caractere
+    if isinstance(valor, str):
+        valor = valor.encode("utf-8")
+    return hmac.compare_digest(valor, PERFIL_TOKEN.encode("utf-8"))
+
+
+# Dependência das rotas de administração dos perfis
+def exigir_token(request: Request):
+    if not token_valido(request.headers.get("x-perfil-token") or request.query_params.get("token")):
+        raise HTTPException(status_code=403, detail="Acesso negado")
+
+
+def _deve_perfilar(scope) -> bool:
+    if PERFIL_TAXA and random.random() < PERFIL_TAXA:
+        return True
+    for nome, valor in scope["headers"]:
+        if nome == PERFIL_HEADER:
+            return token_valido(valor)
+    return False
+
+
+class PerfilMiddleware:
+    """
+    Middleware ASGI que perfila a requisição inteira, incluindo o envio do
+    corpo, quando o cabeçalho X-Perfil traz o PERFIL_TOKEN ou a requisição é
+    sorteada por PERFIL_TAXA.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _deve_perfilar(scope):
+            await self.app(scope, receive, send)
+            return
+
+        perfil = Perfil(scope["method"], scope["path"])
+
+        async def enviar(message):
+            if message["type"] == "http.response.start":
+                perfil.status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-perfil-id", perfil.id.encode())]
+            await send(message)
+
+        token = perfil_atual.set(perfil)
+        _ativar()
+        perfil.iniciar()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            perfil.parar()
+            _desativar()
+            perfil_atual.reset(token)
+            # Esperar a amostragem e gravar o JSON bloqueariam o event loop para todas as requisições
+            threading.Thread(target=_concluir, args=(perfil,), name=f"perfil-salvar-{perfil.id}", daemon=True).start()
+
+
+def _concluir(perfil: Perfil):
+    perfil.aguardar()
+    salvar_perfil(perfil)
+
+
+# Armazenamento dos perfis em um anel limitado no disco
+def salvar_perfil(perfil: Perfil):
+    os.makedirs(PERFIS_DIR, exist_ok=True)
+    caminho = os.path.join(PERFIS_DIR, f"{perfil.id}.json")
+    with open(caminho + ".tmp", "w", encoding="utf-8") as arquivo:
+        json.dump(perfil.para_dict(), arquivo)
+    os.replace(caminho + ".tmp", caminho)
+
+    # Os nomes começam pelo horário, então a ordem alfabética é a cronológica
+    nomes = sorted(nome for nome in os.listdir(PERFIS_DIR) if nome.endswith(".json"))
+    for nome in nomes[:-PERFIL_MAX]:
+        try:
+            os.remove(os.path.join(PERFIS_DIR, nome))
+        except FileNotFoundError:
+            pass
+
+
+def listar_perfis() -> list:
+    """Lista os perfis guardados, do mais recente para o mais antigo."""
+    if not os.path.isdir(PERFIS_DIR):
+        return []
+
+    perfis = []
+    for nome in sorted(os.listdir(PERFIS_DIR), reverse=True):
+        if not nome.endswith(".json"):
+            continue
+        dados = carregar_perfil(nome[:-len(".json")])
+        if dados is None:
+            continue
+        perfis.append({
+            "id": dados["id"],
+            "method": dados["method"],
+            "path": dados["path"],
+            "status": dados["status"],
+            "inicio": dados["inicio"],
+            "duracao": dados["duracao"],
+            "sql": len(dados["sql"]),
+        })
+    return perfis
+
+
+def carregar_perfil(perfil_id: str):
+    if not _ID_VALIDO.match(perfil_id):
+        return None
+    try:
+        with open(os.path.join(PERFIS_DIR, f"{perfil_id}.json"), encoding="utf-8") as arquivo:
+            return json.load(arquivo)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Exportação para ferramentas de flamegraph
+def para_collapsed(dados: dict) -> str:
+    """
+    Formato "collapsed stack" (flamegraph.pl, speedscope), com pesos em microssegundos.
+    SQL e templates aparecem como raízes próprias, sobrepostas ao tempo da pilha Python.
+    """
+    intervalo_us = int(dados["intervalo"] * 1_000_000)
+    linhas = [f"{pilha} {quantidade * intervalo_us}" for pilha, quantidade in dados["amostras"].items()]
+    for raiz, chave in (("[sql]", "sql"), ("[template]", "templates")):
+        for item in dados[chave]:
+            nome = item["nome"].replace(";", ",")
+            linhas.append(f"{raiz};{nome} {int(item['duracao'] * 1_000_000)}")
+    return "\n".join(linhas) + "\n"
+
+
+def para_speedscope(dados: dict) -> dict:
+    """Formato de arquivo do speedscope: pilha Python amostrada e linhas do tempo de SQL e templates."""
+    frames = []
+    indices = {}
+
+    def frame(nome):
+        if nome not in indices:
+            indices[nome] = len(frames)
+            frames.append({"name": nome})
+        return indices[nome]
+
+    intervalo_us = dados["intervalo"] * 1_000_000
+    fim_us = dados["duracao"] * 1_000_000
+
+    amostras = []
+    pesos = []
+    for pilha, quantidade in dados["amostras"].items():
+        amostras.append([frame(nome) for nome in pilha.split(";")])
+        pesos.append(quantidade * intervalo_us)
+
+    perfis = [{
+        "type": "sampled",
+        "name": "python",
+        "unit": "microseconds",
+        "startValue": 0,
+        "endValue": fim_us,
+        "samples": amostras,
+        "weights": pesos,
+    }]
+
+    for nome_perfil, chave in (("sql", "sql"), ("template", "templates")):
+        eventos = []
+        for item in dados[chave]:
+            indice = frame(item["nome"])
+            inicio = item["inicio"] * 1_000_000
+            eventos.append({"type": "O", "frame": indice, "at": inicio})
+            eventos.append({"type": "C", "frame": indice, "at": inicio + item["duracao"] * 1_000_000})
+        # Em empates o fechamento vem antes da abertura seguinte
+        eventos.sort(key=lambda e: (e["at"], e["type"] == "O"))
+        perfis.append({
+            "type": "evented",
+            "name": nome_perfil,
+            "unit": "microseconds",
+            "startValue": 0,
+            "endValue": fim_us,
+            "events": eventos,
+        })
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{dados['method']} {dados['path']}",
+        "exporter": "enduro perfil.py",
+        "shared": {"frames": frames},
+        "profiles": perfis,
+    }
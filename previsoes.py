@@ -0,0 +1,125 @@
+from sqlalchemy.orm import Session, joinedload
+
+from models import Enduro, Competitor, Checkpoint, Previsao
+
+
+# As funções abaixo só fazem flush: a rota faz um único commit com a alteração
+# do competidor, checkpoint ou enduro e a atualização das previsões
+
+# Intervalo entre a largada de um competidor e a do seguinte, em segundos
+INTERVALO_LARGADA = 60
+
+
+def hora_para_segundos(hora: str) -> float:
+    """Converte "HH:MM" ou "HH:MM:SS" para segundos desde a meia-noite."""
+    partes = [int(parte) for parte in hora.split(":")]
+    while len(partes) < 3:
+        partes.append(0)
+    horas, minutos, segundos = partes[:3]
+    return horas * 3600 + minutos * 60 + segundos
+
+
+def agendar_competidor(db: Session, competitor: Competitor):
+    """Cria as previsões de um competidor recém-inscrito em todos os checkpoints do enduro."""
+    enduro = db.query(Enduro).filter(Enduro.id == competitor.enduro_id).first()
+    if not enduro:
+        return
+
+    # A lista de largada segue a ordem de inscrição
+    ordem = db.query(Competitor).filter(
+        Competitor.enduro_id == competitor.enduro_id,
+        Competitor.id < competitor.id,
+    ).count()
+    largada = hora_para_segundos(enduro.hora_largada) + ordem * INTERVALO_LARGADA
+
+    checkpoints = db.query(Checkpoint).filter(Checkpoint.enduro_id == enduro.id).all()
+    db.add_all([
+        Previsao(
+            enduro_id=enduro.id,
+            checkpoint_id=checkpoint.id,
+            competitor_id=competitor.id,
+            ordem_largada=ordem,
+            hora_prevista=largada + checkpoint.time,
+        )
+        for checkpoint in checkpoints
+    ])
+    db.flush()
+
+
+def agendar_checkpoint(db: Session, checkpoint: Checkpoint):
+    """Cria as previsões de todos os competidores para um checkpoint novo."""
+    enduro = db.query(Enduro).filter(Enduro.id == checkpoint.enduro_id).first()
+    if not enduro:
+        return
+
+    largada = hora_para_segundos(enduro.hora_largada)
+    competitors = db.query(Competitor.id).filter(Competitor.enduro_id == enduro.id).order_by(Competitor.id).all()
+    db.add_all([
+        Previsao(
+            enduro_id=enduro.id,
+            checkpoint_id=checkpoint.id,
+            competitor_id=competitor_id,
+            ordem_largada=ordem,
+            hora_prevista=largada + ordem * INTERVALO_LARGADA + checkpoint.time,
+        )
+        for ordem, (competitor_id,) in enumerate(competitors)
+    ])
+    db.flush()
+
+
+def deslocar_checkpoint(db: Session, checkpoint_id: int, delta: float):
+    """Ajusta as previsões de um checkpoint cujo tempo mudou, sem recalcular a largada."""
+    if delta:
+        db.query(Previsao).filter(Previsao.checkpoint_id == checkpoint_id).update(
+            {Previsao.hora_prevista: Previsao.hora_prevista + delta}, synchronize_session=False
+        )
+        db.flush()
+
+
+def deslocar_enduro(db: Session, enduro_id: int, delta: float):
+    """Ajusta todas as previsões de um enduro cuja hora de largada mudou."""
+    if delta:
+        db.query(Previsao).filter(Previsao.enduro_id == enduro_id).update(
+            {Previsao.hora_prevista: Previsao.hora_prevista + delta}, synchronize_session=False
+        )
+        db.flush()
+
+
+def remover_previsoes_enduro(db: Session, enduro_id: int):
+    db.query(Previsao).filter(Previsao.enduro_id == enduro_id).delete(synchronize_session=False)
+    db.flush()
+
+
+def reconstruir_previsoes(db: Session, enduro_id: int):
+    """Recalcula do zero as previsões de um enduro (ex.: dados criados antes da tabela existir)."""
+    db.query(Previsao).filter(Previsao.enduro_id == enduro_id).delete(synchronize_session=False)
+    db.flush()
+    for checkpoint in db.query(Checkpoint).filter(Checkpoint.enduro_id == enduro_id).all():
+        agendar_checkpoint(db, checkpoint)
+
+
+def garantir_previsoes(db: Session, checkpoint: Checkpoint):
+    """
+    Refaz as previsões do enduro se elas não cobrirem todos os competidores em
+    todos os checkpoints (ex.: enduro criado antes da tabela, com inscrições
+    posteriores já agendadas de forma incremental).
+    """
+    enduro_id = checkpoint.enduro_id
+    previstas = db.query(Previsao.id).filter(Previsao.enduro_id == enduro_id).count()
+    competidores = db.query(Competitor.id).filter(Competitor.enduro_id == enduro_id).count()
+    checkpoints = db.query(Checkpoint.id).filter(Checkpoint.enduro_id == enduro_id).count()
+    if previstas != competidores * checkpoints:
+        reconstruir_previsoes(db, enduro_id)
+
+
+def proximos(db: Session, checkpoint_id: int, inicio: float = None, minutos: int = None) -> list:
+    """
+    Previsões de um checkpoint em ordem de horário. Com inicio e minutos,
+    retorna apenas quem deve passar nessa janela, usando o índice por horário.
+    """
+    query = db.query(Previsao).options(joinedload(Previsao.competitor)).filter(Previsao.checkpoint_id == checkpoint_id)
+    if inicio is not None:
+        query = query.filter(Previsao.hora_prevista >= inicio)
+        if minutos is not None:
+            query = query.filter(Previsao.hora_prevista < inicio + minutos * 60)
+    return query.order_by(Previsao.hora_prevista).all()